@@ -31,11 +31,59 @@ Hello, World!
 >>> l
 ['@aaa\n', '@bbb\n', '@ccc\n']
 
+>>> gather(Cmd.true, Cmd.false, Cmd.sh['-c', 'exit 3'])
+[0, 1, 3]
+
+Output goes straight into plain files, but through python for any other
+kind of writer, e.g. one that encodes or compresses:
+
+>>> import codecs, os, shutil, tempfile
+>>> tmpdir = tempfile.mkdtemp()
+>>> path = os.path.join(tmpdir, 'out')
+>>> Cmd.echo['direct'] >> open(path, 'w')
+>>> open(path).read()
+'direct\n'
+>>> Cmd.echo['encoded'] >> codecs.open(path, 'w', encoding='utf-16')
+>>> open(path, 'rb').read().decode('utf-16') == u'encoded\n'
+True
+>>> os.remove(path)
+
+Whole-stream filters add or strip newlines in one pass:
+
+>>> list(['a', 'b\n', 3] / nl_stream)
+['a\n', 'b\n', '3\n']
+>>> list(Cmd.sh['-c', 'echo x; echo y'] / stripnl_stream)
+['x', 'y']
+
+A command can also be started as a writable file feeding its stdin:
+
+>>> upper = Cmd.tr['a-z', 'A-Z'].consumer(stdout=open(path, 'w'))
+>>> written = upper.write(b'shout\n')
+>>> upper.close()
+>>> upper.wait()
+0
+>>> open(path).read()
+'SHOUT\n'
+
+Files on disk are dataflow sources and sinks. Between files, or from a
+command into a file, data is copied without passing through python:
+
+>>> File(path).open().read()
+'SHOUT\n'
+>>> File(path) >> File(path + '.copy')
+>>> Cmd.echo['more'] >> File(path + '.copy').append
+>>> list(File(path + '.copy') / stripnl)
+['SHOUT', 'more']
+>>> shutil.rmtree(tmpdir)
+
 """
 
+# underscored so that "from commander import *" does not export them
+import io as _io, os as _os, re as _re, codecs as _codecs
+
 # This module combines nicely with subprocess2, but it is not required
 try:
-    from subprocess2 import Subprocess, Producer
+    from subprocess2 import Subprocess, Producer, Consumer
 except ImportError:
     from subprocess import Popen as Subprocess
 
@@ -46,19 +94,49 @@ try:
 except ImportError:
     _CmdBase = object
 
+# Command names Cmd['name'] caches: identifiers, optionally with dashes
+_isname = _re.compile(r'[A-Za-z_][A-Za-z0-9_-]*\Z').match
+
+# How Cmd._processargs treats arguments of the most common types
+_STR, _SCALAR, _ITERABLE = 'str', 'scalar', 'iterable'
+_argkinds = {str: _STR, int: _SCALAR, float: _SCALAR, bool: _SCALAR,
+             list: _ITERABLE, tuple: _ITERABLE}
+
 class Cmd(_CmdBase):
     """ Object describing an executable command """
     # Object attrs are named arguments to Subprocess (i.e. subprocess.Popen)
+    # Commands are treated as immutable: update() always returns a new one
+    __slots__ = ('__dict__', '__weakref__', '_repr')
 
-    # Make Cmd.name and Cmd['name'] shortcuts to Cmd(args=['name'])
+    # Make Cmd.name and Cmd['name'] shortcuts to Cmd(args=('name',))
     class __metaclass__(type):
+        # Cmd.name and Cmd['name'] objects are shared between accesses
+        _names = {}
+        _items = {}
+
         def __getattr__(cls, name):
             if name.startswith('_'):
                 raise AttributeError
-            return Cmd(args=[name.replace('_', '-')])
+            try:
+                return cls._names[name]
+            except KeyError:
+                cmd = cls._names[name] = Cmd(args=(name.replace('_', '-'),))
+                return cmd
 
         def __getitem__(cls, args):
-            return Cmd(args=args if isinstance(args, (tuple, list)) else [args])
+            if isinstance(args, (tuple, list)):
+                return Cmd(args=tuple(args))
+            # only names as found in source code are cached; paths and
+            # argument tuples are unbounded
+            try:
+                return cls._items[args]
+            except KeyError:
+                cmd = Cmd(args=(args,))
+                if isinstance(args, str) and _isname(args):
+                    cls._items[args] = cmd
+                return cmd
+            except TypeError:   # unhashable
+                return Cmd(args=(args,))
 
     def __init__(self, *dummy, **kw):
         """ Initialize a command. Normally not called directly. """
@@ -69,37 +147,84 @@ class Cmd(_CmdBase):
 
     def __repr__(self):
         """ Make eval(repr(command)) == command """
-        argrepr = ["%s=%r" % item for item in sorted(vars(self).items())]
-        return "%s(%s)" % (self.__class__.__name__, ', '.join(argrepr))
+        try:
+            return self._repr
+        except AttributeError:
+            argrepr = ["%s=%r" % item for item in sorted(vars(self).items())]
+            rep = "%s(%s)" % (self.__class__.__name__, ', '.join(argrepr))
+            object.__setattr__(self, '_repr', rep)
+            return rep
+
+    def __reduce__(self):
+        # copy and pickle only the arguments, not the cached repr
+        return self.__class__, (), dict(vars(self))
+
+    def __setattr__(self, name, value):
+        # Cmd.name objects are shared: changing one would change them all
+        raise AttributeError("Cmd objects are immutable, use update()")
+
+    def __delattr__(self, name):
+        raise AttributeError("Cmd objects are immutable, use update()")
 
     def update(self, *newargs, **newkw):
         """ Return new command object with additional arguments """
         kw = dict(vars(self))
-        args = list(kw.pop('args'))
+        args = kw['args']
+        extra = newargs
 
         for newarg in newargs:
             if isinstance(newarg, dict):
-                kw.update(newarg)
-            else:
-                args.append(newarg)
-        kw.update(newkw, args=args)
-        return Cmd(**kw)
+                # split keyword dicts out of the positional arguments
+                extra = []
+                for newarg in newargs:
+                    if isinstance(newarg, dict):
+                        kw.update(newarg)
+                    else:
+                        extra.append(newarg)
+                extra = tuple(extra)
+                break
+        kw.update(newkw)
+        # args is an immutable tuple, so it is shared if unchanged
+        if type(args) is not tuple:
+            args = tuple(args)
+        if extra:
+            args += extra
+        kw['args'] = args
+        return Cmd._fromdict(kw)
+
+    @classmethod
+    def _fromdict(cls, kw):
+        """ Create command using dict kw as its attributes, without copying """
+        cmd = object.__new__(cls)
+        object.__setattr__(cmd, '__dict__', kw)
+        return cmd
 
     def __getitem__(self, arg):
         """ Syntactic sugar for .update(). Use dict() for keyword args """
-        if not isinstance(arg, tuple):
-            arg = (arg,)
-        return self.update(*arg)
+        return self.update(*(arg if arg.__class__ is tuple else (arg,)))
+
+    def _popenargs(self, kw):
+        """ Arguments to start this command with, kw overriding attributes
+            other than args, as with update() """
+        merged = dict(vars(self), **kw)
+        merged['args'] = self._processargs(self.args)
+        return merged
 
-    def subprocess(self):
-        """ Start a subprocess object described by this command """
-        kw = vars(self).copy()
-        kw['args'] = self._processargs(kw['args'])
-        return Subprocess(**kw)
+    def subprocess(self, **kw):
+        """ Start a subprocess object described by this command.
+            Keyword arguments override the command's own attributes """
+        return Subprocess(**self._popenargs(kw))
+
+    def consumer(self, **kw):
+        """ Start a Consumer subprocess: a writable file feeding its stdin """
+        return Consumer(**self._popenargs(kw))
 
     def __call__(self, *args, **kw):
         """ Add arguments, start subprocess, wait for completion """
-        return self.update(*args, **kw).subprocess().wait()
+        if args:
+            return self.update(*args, **kw).subprocess().wait()
+        # keyword arguments alone need no intermediate command object
+        return self.subprocess(**kw).wait()
 
     # implements the iterator protocol - use this command as data source (requires subprocess2)
     def __iter__(self):
@@ -108,7 +233,23 @@ class Cmd(_CmdBase):
 
     # implements the dataflow feed protocol - use this command as data sink 
     def __feed__(self, source):
-        return self.update(stdin=source)()
+        return self(stdin=source)
+
+    # implements the dataflow collusion protocol - write output straight into
+    # a sink with a file descriptor instead of copying it through python
+    def __feedto__(self, sink, upstream):
+        kw = vars(self)
+        if 'stdout' in kw or kw.get('universal_newlines'):
+            return NotImplemented
+        if isinstance(sink, File):
+            with sink.open(write=True) as f:
+                return self.__feedto__(f, upstream)
+        if not _israwfile(sink):
+            return NotImplemented
+        sink.flush()            # keep order with data already buffered
+        if upstream is None:
+            return self(stdout=sink)
+        return self(stdin=upstream, stdout=sink)
 
     # implements the dataflow filter protocol - apply this command to upstream source 
     def __filt__(self, upstream):
@@ -117,26 +258,77 @@ class Cmd(_CmdBase):
     @staticmethod
     def _processargs(args, maxdepth=3):
         """ Expand iterable arguments """
-
-        def recurse(args, depth=0):
-            """ recurse except strings, strip newlines except top level """
-            for arg in args:
-                if isinstance(arg, str):
+        # walk nested iterables with an explicit stack of iterators;
+        # recurse except strings, strip newlines except top level
+        out = []
+        stack = [iter(args)]
+        while stack:
+            depth = len(stack) - 1
+            for arg in stack[-1]:
+                kind = _argkinds.get(type(arg))
+                if kind is None:
+                    # not a common type: classify the slow way, once per type
+                    if isinstance(arg, str):
+                        kind = _STR
+                    else:
+                        try:
+                            iter(arg)
+                        except TypeError:
+                            kind = _SCALAR
+                        else:
+                            kind = _ITERABLE
+                    # remember only what holds for every instance: some
+                    # types have non-iterable instances (e.g. numpy 0-d)
+                    if kind is not _SCALAR and type(arg) is arg.__class__:
+                        _argkinds[type(arg)] = kind
+                if kind is _STR:
                     if depth > 1:
                         arg = arg.rstrip('\n')
-                    yield arg
-                elif depth > maxdepth:
-                    yield str(arg)
+                    out.append(arg)
+                elif kind is _SCALAR or depth > maxdepth:
+                    out.append(str(arg))
                 else:
                     try:
                         iterator = iter(arg)
-                    except TypeError:
-                        yield str(arg)
-                    else:
-                        for x in recurse(iterator, depth + 1):
-                            yield x
+                    except TypeError:   # this instance does not iterate
+                        out.append(str(arg))
+                        continue
+                    stack.append(iterator)
+                    break
+            else:
+                stack.pop()
+        return out
+
+try:
+    _file = file
+except NameError:           # python 3
+    _file = _io.FileIO
+
+def _israwfile(f):
+    """ Whether bytes written to f's fd are what writing them to f does:
+        true for plain files, false for e.g. gzip or codecs writers """
+    if type(f) is _io.TextIOWrapper:
+        try:
+            if _codecs.lookup(f.encoding).name != 'utf-8' or _os.linesep != '\n':
+                return False
+        except LookupError:
+            return False
+        f = f.buffer
+    if type(f) in (_io.BufferedWriter, _io.BufferedRandom):
+        f = f.raw
+    if type(f) not in (_file, _io.FileIO):
+        return False
+    try:
+        f.fileno()
+    except (ValueError, IOError, OSError):
+        return False        # closed
+    return True
 
-        return list(recurse(args))
+def gather(*cmds):
+    """ Run commands concurrently: start them all, then wait for each.
+    Returns the list of exit codes. """
+    procs = [cmd.subprocess() for cmd in cmds]
+    return [proc.wait() for proc in procs]
 
 if __name__ == '__main__':
     import doctest
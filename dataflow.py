@@ -57,12 +57,28 @@ The following statements are also equivalent:
 Note that the dataflow direction is from left to right while chaining
 of function calls generally works right to left.
 
-TODO: Allow last and second-to-last dataflow stages to collude in bypassing
-iterator protocol (e.g. sink is writable file, prev stage is a subprocess)
+The last and second-to-last stages of a dataflow may collude in bypassing
+the iterator protocol (e.g. sink is writable file, prev stage is a
+subprocess). If the stage before the sink has a __feedto__ method it is
+called as stage.__feedto__(sink, upstream), with upstream None if that
+stage is the source. Returning NotImplemented falls back to feed().
 """
 
+import io
+import os
+import stat
+import errno
+from itertools import groupby
+from operator import methodcaller, itemgetter
+
+try:
+    from itertools import imap
+except ImportError:
+    imap = map
+
 class DataflowOps(object):
     """ Adds / and >> dataflow operators to an object """
+    __slots__ = ()
     def __div__(self, right):
         """ Concatenate dataflows or stages """
         return Dataflow(self, right)
@@ -73,10 +89,10 @@ class DataflowOps(object):
 
     def __rshift__(self, right):
         """ Concatenate and start dataflow """
-        ( Dataflow(self) / Dataflow(right) )()
+        Dataflow(self, right)()
 
     def __rrshift__(self, left):
-        ( Dataflow(left) / Dataflow(self) )()
+        Dataflow(left, self)()
 
 
 def filt(filter, upstream):
@@ -96,23 +112,55 @@ def feed(sink, source):
     """ Feed source iterator into a data sink """
     if hasattr(sink, '__feed__'):
         return sink.__feed__(source)
-    elif type(sink) in feed_registry:
-        feed_registry[type(sink)](sink, source)
+    feeder = feed_registry.get(type(sink)) or _inherited_feeder(type(sink))
+    if feeder is not None:
+        feeder(sink, source)
     elif callable(sink):
         # feed items individually
         for x in source:
             sink(x)
     elif hasattr(sink, 'write'):
-        # feed items individually, converting to string first
-        for x in source:
-            if not isinstance(x, str):
-                x = '%s\n' % x
-            sink.write(x)
+        feed_write(sink, source)
     else:
         raise TypeError("sink: %r object is not a valid data sink"
                 % sink.__class__.__name__)
 
 
+def feed_write(f, source, blocksize=65536):
+    """ Write items to file-like object, converting to string first """
+    write = f.write
+    try:
+        regular = stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, ValueError, EnvironmentError):
+        regular = False
+    if not regular:
+        # don't hold back output a user or reader may be waiting for
+        blocksize = 0
+    buf, size = [], 0
+    for x in source:
+        if not isinstance(x, str):
+            x = '%s\n' % x
+        buf.append(x)
+        size += len(x)
+        if size >= blocksize:
+            _writejoined(write, buf)
+            buf, size = [], 0
+    if buf:
+        _writejoined(write, buf)
+
+def _writejoined(write, items):
+    """ Write items with one call, or one by one if they cannot be joined
+        (python 2: non-ascii str mixed with unicode) """
+    if len(items) == 1:
+        return write(items[0])
+    try:
+        data = ''.join(items)
+    except UnicodeError:
+        for x in items:
+            write(x)
+    else:
+        write(data)
+
 def feed_list(l, source):
     """ Replace list contents with iterable source """
     l[:] = source
@@ -131,19 +179,73 @@ feed_registry = {
     list : feed_list,
     set : feed_set,
     type(None): feed_null,
+    io.IOBase : feed_write,
 }
+try:
+    feed_registry[file] = feed_write
+except NameError:
+    pass
+
+_inherited = {}         # type -> nearest registered base class, or None
+_inherited_size = None  # size of feed_registry when _inherited was filled
+
+def _inherited_feeder(cls):
+    """ Feeder registered for the nearest base class of cls, if any """
+    global _inherited_size
+    if _inherited_size != len(feed_registry):
+        _inherited.clear()      # registrations changed: resolve again
+        _inherited_size = len(feed_registry)
+    try:
+        base = _inherited[cls]
+    except KeyError:
+        for base in getattr(cls, '__mro__', ()):
+            if base in feed_registry:
+                break
+        else:
+            base = None
+        _inherited[cls] = base
+    return feed_registry.get(base)
+
+def _compile(stages):
+    """ Resolve stages once into (peritem, filter) pairs """
+    return tuple((callable(stage) and not hasattr(stage, '__filt__'), stage)
+                 for stage in stages)
+
+def _run(plan, stream):
+    """ Apply compiled stages to stream """
+    for peritem, f in plan:
+        # per-item filters are chained as imap() layers: the loop runs in
+        # C, no Python frame per item as in a generator or composed function
+        stream = imap(f, stream) if peritem else filt(f, stream)
+    return stream
 
 class Dataflow(DataflowOps):
     """ Object representing recipe for a data flow """
 
     def __init__(self, *stages):
+        if len(stages) == 1 and stages[0].__class__ is Dataflow:
+            # stages are immutable once flattened: share them
+            self.stages = stages[0].stages
+            self._plans = {}
+            return
         flat = []
+        append, extend = flat.append, flat.extend
+        cls = Dataflow
         for stage in stages:
-            if stage.__class__ is Dataflow:
-                flat.extend(stage.stages)
+            if stage.__class__ is cls:
+                extend(stage.stages)
             else:
-                flat.append(stage)
+                append(stage)
         self.stages = tuple(flat)
+        self._plans = {}
+
+    @classmethod
+    def _fromstages(cls, stages):
+        """ Create dataflow from a tuple of already flattened stages """
+        self = object.__new__(cls)
+        self.stages = stages
+        self._plans = {}
+        return self
 
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__,
@@ -153,26 +255,33 @@ class Dataflow(DataflowOps):
         """ Iterate first stage, applying the next stages as filters """
         if len(self.stages) == 0:
             return iter(())
-        else:
-            first, rest = self.stages[0], self.stages[1:]
-            return filt(Dataflow(*rest), iter(first))
+        return _run(self._plan(1), iter(self.stages[0]))
 
     def __filt__(self, upstream):
         """ Apply dataflow as a filter to specified upstream source """
         if len(self.stages) == 0:
             return upstream
-        else:
-            laststage = self.stages[-1]
-            # construct dataflow consisting of the upstream source
-            # followed by all filter stages but the last:
-            upstream2 = Dataflow(*(upstream,) + self.stages[:-1])
-            # And apply last stage as filter to this upstream source
-            return filt(laststage, upstream2)
+        return _run(self._plan(0), iter(upstream))
+
+    def _plan(self, start):
+        """ Compiled filters for stages[start:], resolved on first use """
+        try:
+            return self._plans[start]
+        except KeyError:
+            plan = self._plans[start] = _compile(self.stages[start:])
+            return plan
 
     def __call__(self):
         """ Run dataflow. Last stage must be a valid sink. """
-        sink = self.stages[-1]
-        feed(sink, Dataflow(*self.stages[:-1]) )
+        stages = self.stages
+        sink = stages[-1]
+        stage = stages[-2] if len(stages) > 1 else None
+        # a class stage (e.g. a filter like File) has the hook only unbound
+        if hasattr(stage, '__feedto__') and not isinstance(stage, type):
+            upstream = Dataflow._fromstages(stages[:-2]) if len(stages) > 2 else None
+            if stage.__feedto__(sink, upstream) is not NotImplemented:
+                return
+        feed(sink, Dataflow._fromstages(stages[:-1]) )
 
 
 class File(DataflowOps):
@@ -184,16 +293,54 @@ class File(DataflowOps):
     def __repr__(self):
         return "%s(%r%s)" % (self.__class__.__name__, self.filename, ', append=True' if self.appendmode else '')
 
-    def __iter__(self):
+    def open(self, write=False):
+        """ Open file for reading, or for writing in the file's mode """
+        if write:
+            return open(self.filename, 'a' if self.appendmode else 'w')
         return open(self.filename)
 
+    def __iter__(self):
+        return self.open()
+
     def __feed__(self, source):
-        feed(open(self.filename, 'a' if self.appendmode else 'w'), source)
+        with self.open(write=True) as f:
+            feed(f, source)
+
+    # implements the dataflow collusion protocol - copy file to file in the
+    # kernel where possible instead of iterating over lines
+    def __feedto__(self, sink, upstream):
+        if upstream is not None or not isinstance(sink, File):
+            return NotImplemented
+        with self.open() as src:
+            with sink.open(write=True) as dst:
+                _copyfile(src.fileno(), dst.fileno())
 
     @property
     def append(self):
         return type(self)(self.filename, append=True)
 
+def _copyfile(infd, outfd, blocksize=1<<20):
+    """ Copy rest of file descriptor infd to outfd """
+    sendfile = getattr(os, 'sendfile', None)
+    copied = 0
+    if sendfile is not None:
+        try:
+            while True:
+                n = sendfile(outfd, infd, None, blocksize)
+                if not n:
+                    return
+                copied += n
+        except OSError as e:
+            # not supported for this pair of files: copy by hand instead
+            if copied or e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+    while True:
+        buf = os.read(infd, blocksize)
+        if not buf:
+            return
+        while buf:
+            buf = buf[os.write(outfd, buf):]
+
 class URL(DataflowOps):
     """ Class representing a URL. Read only. """
     def __init__(self, url):
@@ -220,23 +367,32 @@ class Filter(DataflowOps):
 
 @Filter
 def uniq(upstream):
-    """ Sample filter """
-    last = object()
-    for x in upstream:
-        if x != last:
-            yield x
-        last = x
+    """ Sample filter: drop adjacent repeated items """
+    return imap(itemgetter(0), groupby(upstream))
 
 def nl(x):
     """ Convert to string and add a newline, if necessary """
-    if type(x) is str and x.endswith('\n'):
-        return x
-    else:
-        return '%s\n' % x
+    if type(x) is str:
+        return x if x.endswith('\n') else x + '\n'
+    return '%s\n' % x
 
 def stripnl(x):
     """ Remove trailing newline """
     return x.rstrip('\n')
 
+@Filter
+def nl_stream(upstream):
+    """ Whole-stream nl: no function call per item """
+    return (x if type(x) is str and x.endswith('\n') else '%s\n' % x
+            for x in upstream)
+
+_rstripnl = methodcaller('rstrip', '\n')
+
+@Filter
+def stripnl_stream(upstream):
+    """ Whole-stream stripnl: rstrip is called from C, no frame per item """
+    return imap(_rstripnl, upstream)
+
 
-__all__ = ['Dataflow', 'filt', 'feed', 'File', 'URL', 'uniq', 'nl', 'stripnl']
+__all__ = ['Dataflow', 'filt', 'feed', 'File', 'URL', 'uniq', 'nl', 'stripnl',
+           'nl_stream', 'stripnl_stream']
@@ -6,8 +6,61 @@ serialized safe wrapper threads
 broken pipe signal
 """
 
-import subprocess, io, os, threading
+import subprocess, io, os, sys, errno, threading, atexit, fcntl, select
 from subprocess import PIPE, STDOUT
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Linux-only kernel facilities used by Iter2Pipe when available
+_writev = getattr(os, 'writev', None)
+if sys.platform.startswith('linux'):
+    _F_SETPIPE_SZ, _F_GETPIPE_SZ = 1031, 1032
+else:
+    _F_SETPIPE_SZ = _F_GETPIPE_SZ = None
+
+def _pipe_size(want=1 << 20):
+    """ Pipe capacity to ask for: want, bounded by the system maximum """
+    try:
+        with open('/proc/sys/fs/pipe-max-size') as f:
+            return min(want, int(f.read()))
+    except (IOError, OSError, ValueError):
+        return want
+
+_PIPE_SIZE = _pipe_size()
+_PIPE_DEFAULT = 1 << 16     # capacity of a new pipe on linux
+
+def _growpipe(fd, size):
+    """ Enlarge pipe fd towards holding size bytes; returns its capacity.
+        Each enlarged pipe counts against the user's pipe buffer limit, so
+        this is only worth it for large amounts of data. """
+    if _F_SETPIPE_SZ is not None and size > _PIPE_DEFAULT:
+        try:
+            _fcntl(fd, _F_SETPIPE_SZ, min(size, _PIPE_SIZE))
+            return _fcntl(fd, _F_GETPIPE_SZ)
+        except (IOError, OSError):
+            pass    # e.g. user over pipe-user-pages-soft
+    return _PIPE_DEFAULT
+
+def _pipe_blksize():
+    """ Preferred I/O block size of a pipe; the same for every pipe """
+    try:
+        readfd, writefd = os.pipe()
+    except OSError:
+        return 2048
+    try:
+        return os.fstat(writefd).st_blksize
+    except (os.error, AttributeError):
+        return 2048     # too small better than too big - may cause blocking
+    finally:
+        os.close(readfd)
+        os.close(writefd)
+
+_PIPE_BLKSIZE = _pipe_blksize()
+
+_fcntl = fcntl.fcntl
+_F_GETFD, _F_SETFD, _FD_CLOEXEC = fcntl.F_GETFD, fcntl.F_SETFD, fcntl.FD_CLOEXEC
 
 class Subprocess(subprocess.Popen):
     """ Similar to subprocess.Popen with the following enhancement:
@@ -18,45 +71,94 @@ class Subprocess(subprocess.Popen):
         if 'stdin' in kw:
             kw['stdin'] = self._asfiledesc(kw['stdin'])
         self._errorlevel = kw.pop('errorlevel', None)
-        self._cmd = subprocess.list2cmdline(args)[:200]
-        subprocess.Popen.__init__(self, args=args, **kw)
+        self._cmdargs = args        # formatted only if an error is raised
+        try:
+            subprocess.Popen.__init__(self, args=args, **kw)
+        finally:
+            # the child has its own copy of a bridge's read end now; the
+            # parent's must go, or the reader exiting is never noticed
+            if isinstance(kw.get('stdin'), Iter2Pipe):
+                kw['stdin']._closefd()
 
     def _handle_exitstatus(self, sts):
         subprocess.Popen._handle_exitstatus(self, sts)
         if self._errorlevel is not None:
             if self.returncode >= self._errorlevel or self.returncode < 0:
-                raise subprocess.CalledProcessError(self.returncode, self._cmd)
+                cmd = subprocess.list2cmdline(self._cmdargs)[:200]
+                raise subprocess.CalledProcessError(self.returncode, cmd)
 
     @staticmethod
     def _asfiledesc(arg):
         """ Convert argument into something that has a file descriptor """
-        if hasattr(arg, 'fileno') or isinstance(arg, int):
-            return arg                      # use as-is
-
-        if isinstance(arg, str):
-            # special case strings to avoid iteration char by char
+        kind = _stdinkinds.get(type(arg))
+        if kind is None:
+            if _hasfd(arg):
+                return arg                  # use as-is, child reads it directly
+            if isinstance(arg, int):
+                kind = _FD
+            elif isinstance(arg, (str, bytes, list, tuple)):
+                kind = _DATA
+        if kind is _FD:
+            return arg
+
+        if kind is _DATA:
+            if hasattr(os, 'memfd_create'):
+                # small in-memory data: hand the child a prefilled memory
+                # file, no bridge thread or pipe needed
+                data = _serialize(arg, _MEMFILE_MAX)
+                if data is not None:
+                    return _memfile(data)
+            else:
+                # data that fits in an empty pipe is written right away
+                data = _serialize(arg, _PIPE_BLKSIZE)
+                if data is not None:
+                    return _filledpipe(data)
+            # special case strings to avoid iteration char by char, and
+            # let in-memory sequences go to the pump
             return Iter2Pipe(arg)
 
         iterator = iter(arg)
 
-        if hasattr(iterator, 'fileno'):     # an iterator with a fileno?
+        if _hasfd(iterator):                # an iterator with a fileno?
             return iterator                 # (e.g. file, urlopen, producer)
         else:
             return Iter2Pipe(iterator)      # no, wrap in bridge thread
 
+# How Subprocess._asfiledesc treats stdin arguments of the most common types
+_FD, _DATA = 'fd', 'data'
+_stdinkinds = {int: _FD, str: _DATA, bytes: _DATA, list: _DATA, tuple: _DATA}
+
+def _hasfd(obj):
+    """ Whether obj is backed by an open file descriptor """
+    try:
+        os.fstat(obj.fileno())
+    except (AttributeError, ValueError, TypeError, IOError, OSError):
+        return False        # e.g. BytesIO: fileno() exists but raises
+    return True
+
+# Popen arguments that make its pipes text files
+_TEXTMODE_ARGS = ('universal_newlines', 'text', 'encoding', 'errors')
+
 class Producer(Subprocess, io.BufferedReader):
     """ Exposes a readable file-like interface to stdout of a subprocess """
     def __init__(self, args, **kw):
         if 'stdout' in kw:
             raise ValueError("Producer: stdout already overridden")
+        if any(kw.get(k) for k in _TEXTMODE_ARGS):
+            # a buffered reader reads bytes, not decoded text
+            raise ValueError("Producer: text mode (universal_newlines) not supported")
         kw['stdout'] = subprocess.PIPE
         Subprocess.__init__(self, args, **kw)
 
-        fd = os.dup(self.stdout.fileno())   # prevents closing of pipe
-        self.stdout = None                  #  when stdout file object dies
-
-        filemode = 'rU' if kw.get('universal_newlines', False) else 'r'
-        io.BufferedReader.__init__(self, io.FileIO(fd, filemode))
+        stdout, self.stdout = self.stdout, None
+        try:
+            # take over the pipe's raw file from its buffered wrapper
+            raw = stdout.detach()
+        except AttributeError:
+            # python 2 file object: dup prevents closing of pipe when
+            # stdout file object dies
+            raw = io.FileIO(os.dup(stdout.fileno()), 'r')
+        io.BufferedReader.__init__(self, raw)
 
 
 class Consumer(Subprocess, io.BufferedWriter):
@@ -69,115 +171,438 @@ class Consumer(Subprocess, io.BufferedWriter):
 
         fd = os.dup(self.stdin.fileno())    # prevents closing of pipe
         self.stdin = None                   #  when stdin file object dies
-        io.BufferedWriter.__init__(self, io.FileIO(fd), 'w')
+        io.BufferedWriter.__init__(self, io.FileIO(fd, 'w'))
+
+
+def _asbytes(x):
+    """ Convert a stdin iterator item to the bytes written for it """
+    if isinstance(x, bytes):
+        return x
+    if not isinstance(x, str):
+        x = '%s\n' % x
+    return x if isinstance(x, bytes) else x.encode('utf-8')
+
+_MEMFILE_MAX = 1 << 20
+
+def _serialize(obj, limit):
+    """ Stdin data of a string or sequence as bytes, None if over limit """
+    if isinstance(obj, (str, bytes)):
+        data = obj if isinstance(obj, bytes) else obj.encode('utf-8')
+        return data if len(data) <= limit else None
+    items, size = [], 0
+    for x in obj:
+        x = _asbytes(x)
+        size += len(x)
+        if size > limit:
+            return None
+        items.append(x)
+    return b''.join(items)
+
+def _memfile(data):
+    """ Anonymous in-memory file holding data, positioned at the start """
+    f = io.FileIO(os.memfd_create('subprocess2', os.MFD_CLOEXEC), 'r+')
+    view = memoryview(data)
+    while view:
+        view = view[f.write(view):]
+    f.seek(0)
+    return f
+
+def _filledpipe(data):
+    """ Read end of a pipe holding all of data, write end closed """
+    readfd, writefd = _cloexec_pipe()
+    try:
+        os.write(writefd, data)     # never blocks: data fits a pipe buffer
+    finally:
+        os.close(writefd)
+    return io.FileIO(readfd, 'r')
 
 
 class _RawIterIO(io.BufferedIOBase):
     """ Helper class for turning python iterator to a file-like object """
+    __slots__ = ('iterator', 'chunk', 'offset')
+
     def __init__(self, iterable):
         self.iterator = self.sourcereader(iterable)
-        self.remainder = None
+        self.chunk = b''        # current item, consumed from offset
+        self.offset = 0
 
     def sourcereader(self, iterable):
-        for x in iterable:
-            if not isinstance(x, str):
-                x = '%s\n' % x
-            yield x
+        """ Yield source items as bytes, small items joined per chunk.
+
+        The iterator may block between items, so a chunk is passed on as
+        soon as another item like the last one would not fit in a pipe
+        block: never more than that is held back waiting for the next.
+        """
+        iterator = iter(iterable)
         iterable = None     # let gc do its work
-        while True:
-            yield ''
+        limit = _PIPE_BLKSIZE
+        batch, size = [], 0
+        for x in iterator:
+            if type(x) is not bytes:
+                x = _asbytes(x)
+            batch.append(x)
+            size += len(x)
+            if size + len(x) > limit:
+                yield x if len(batch) == 1 else b''.join(batch)
+                batch, size = [], 0
+        if size:                # an empty chunk must not look like EOF
+            yield b''.join(batch)
 
     def readable(self):
         return True
 
     def read(self, n=None):
-        """ Read no more than n bytes from source """
-        if self.remainder:
-            data = self.remainder
-            self.remainder = None
-        else:
-            data = next(self.iterator)
-        if n is not None and 0 < n < len(data):
-            data, self.remainder = data[:n], data[n:]
-        return data
+        """ Read no more than n bytes from source, joining items as needed """
+        chunk, offset = self.chunk, self.offset
+        if n is None or n <= 0:
+            if offset >= len(chunk):
+                chunk, offset = next(self.iterator, b''), 0
+            self.chunk, self.offset = chunk, len(chunk)
+            return chunk[offset:] if offset else chunk
+        parts = self.readv(n)
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def readv(self, n, least=None, maxparts=64):
+        """ Read no more than n bytes from source as a list of buffers,
+            returning as soon as at least least bytes (default n) are read """
+        if least is None:
+            least = n
+        chunk, offset = self.chunk, self.offset
+        parts, size = [], 0
+        while size < least and len(parts) < maxparts:
+            if offset >= len(chunk):
+                chunk, offset = next(self.iterator, b''), 0
+                if not chunk:
+                    break
+            end = min(len(chunk), offset + n - size)
+            # slice only what is returned, never copy the unread tail
+            parts.append(chunk[offset:end] if offset or end < len(chunk) else chunk)
+            size += end - offset
+            offset = end
+        self.chunk, self.offset = chunk, offset
+        return parts or [b'']
 
     def close(self):
         io.BufferedIOBase.close(self)
         self.iterator = None
+        self.chunk = b''
+
+
+def _cloexec_pipe():
+    """ Create a pipe whose ends are not inherited by child processes """
+    if hasattr(os, 'pipe2'):
+        # Set close-on-exec on both ends in one syscall. Popen dup2()s
+        # the read end onto the child's stdin, which clears the flag.
+        return os.pipe2(os.O_CLOEXEC)
+    readfd, writefd = os.pipe()
+    if not hasattr(os, 'set_inheritable'):
+        # before PEP 446 (python 3.4) new fds were inheritable by default
+        for fd in readfd, writefd:
+            _fcntl(fd, _F_SETFD, _fcntl(fd, _F_GETFD) | _FD_CLOEXEC)
+    return readfd, writefd
+
+def _writeall(fd, parts):
+    """ Write a list of buffers to fd, in one writev() call if possible """
+    while parts:
+        if _writev is not None and len(parts) > 1:
+            n = _writev(fd, parts)
+        else:
+            n = os.write(fd, parts[0])
+        # drop buffers written completely, slice the first partial one
+        i = 0
+        while i < len(parts) and n >= len(parts[i]):
+            n -= len(parts[i])
+            i += 1
+        parts = parts[i:]
+        if n:
+            parts[0] = parts[0][n:]
+
+def _set_nonblocking(fd):
+    _fcntl(fd, fcntl.F_SETFL, _fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+# re-raise an exception from another thread with its original traceback;
+# the python 2 syntax is compiled once, here, rather than on every raise
+if sys.version_info[0] >= 3:
+    def _reraise(etype, evalue, traceback):
+        raise evalue.with_traceback(traceback)
+else:
+    exec('def _reraise(etype, evalue, traceback):\n'
+         '    raise etype, evalue, traceback\n')
+
+
+def _atfork_child(func):
+    """ Have func called in the child process after os.fork(), if possible """
+    register = getattr(os, 'register_at_fork', None)
+    if register is not None:
+        register(after_in_child=func)
+
+
+class _FeederPool(object):
+    """ Shared daemon threads running Iter2Pipe bridges """
+    max_idle = 8
+
+    def __init__(self):
+        self._reset()
+        # let pending bridges finish feeding before the interpreter exits
+        atexit.register(self._join)
+        _atfork_child(self._reset)
+
+    def _reset(self):
+        """ Start over empty: in a forked child the workers are gone """
+        self._pid = os.getpid()
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = 0
+
+    def _join(self):
+        if self._pid == os.getpid():
+            self._tasks.join()
+
+    def submit(self, task):
+        """ Run task on an idle worker, starting a new one if none is idle """
+        if self._pid != os.getpid():
+            self._reset()       # forked, and no at-fork hook ran
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+            else:
+                # Never queue behind a busy worker: bridges in a pipeline
+                # may depend on each other to make progress
+                worker = threading.Thread(target=self._worker)
+                worker.daemon = True
+                worker.start()
+        self._tasks.put(task)
+
+    def _worker(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                task()
+            finally:
+                task = None
+                self._tasks.task_done()
+            with self._lock:
+                if self._idle >= self.max_idle:
+                    return
+                self._idle += 1
 
+_feeders = _FeederPool()
 
-def make_readable(obj):
-    """ Adapt object into something that has a .read() method """
-    if hasattr(obj, 'read'):
-        return obj
-    elif isinstance(obj, str):
-        from cStringIO import StringIO
-        return StringIO(obj)
-    else:
-        # assume it's somehow iterable:
-        return io.BufferedReader(_RawIterIO(obj))
 
+_PUMP_MAX = 1 << 24     # larger sequences are streamed by a feeder
 
-class Iter2Pipe(threading.Thread):
-    """ Bridge thread from python iterator to a pipe """
+class _Pump(object):
+    """ A single thread writing in-memory data to many pipes.
+
+    Unlike iterators, in-memory data never blocks on its source, so one
+    epoll (or poll) loop can serve any number of pipes with nonblocking
+    writes. The loop runs as a feeder pool task while there is data
+    pending.
+    """
+    def __init__(self):
+        self._reset()
+        _atfork_child(self._afterfork)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._new = []
+        self._pending = {}      # owned by the loop while running
+        self._running = False
+        self._wakefds = None
+
+    def _afterfork(self):
+        """ In a forked child, drop the parent's pipes: close our copies
+            of their write ends so the parent's readers still see EOF """
+        fds = list(self._pending) + [fd for fd, data in self._new]
+        for fd in fds + list(self._wakefds or ()):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._reset()
+
+    def add(self, fd, data):
+        """ Write data to pipe fd in the background, then close fd """
+        if self._pid != os.getpid():
+            self._afterfork()   # forked, and no at-fork hook ran
+        _set_nonblocking(fd)
+        with self._lock:
+            if self._wakefds is None:
+                self._wakefds = _cloexec_pipe()
+                for wakefd in self._wakefds:
+                    _set_nonblocking(wakefd)
+            self._new.append((fd, data))
+            start, self._running = not self._running, True
+        if start:
+            _feeders.submit(self._run)
+        else:
+            try:
+                os.write(self._wakefds[1], b'x')
+            except OSError:
+                pass    # pipe full: a wakeup is already pending
+
+    def _run(self):
+        """ Poll loop; returns once all pipes are done """
+        if hasattr(select, 'epoll'):
+            poller = select.epoll()
+            _fcntl(poller.fileno(), _F_SETFD, _FD_CLOEXEC)
+            try:
+                self._loop(poller)
+            finally:
+                poller.close()
+        else:
+            self._loop(select.poll())
+
+    def _loop(self, poller):
+        # epoll and poll event bits have the same values on Linux
+        wakefd = self._wakefds[0]
+        poller.register(wakefd, select.POLLIN)
+        pending = self._pending
+        while True:
+            with self._lock:
+                new, self._new = self._new, []
+                if not new and not pending:
+                    self._running = False
+                    break
+            for fd, data in new:
+                pending[fd] = memoryview(data)
+                poller.register(fd, select.POLLOUT)
+
+            for fd, event in poller.poll():
+                if fd == wakefd:
+                    try:
+                        os.read(wakefd, 4096)
+                    except OSError:
+                        pass
+                    continue
+                view = pending[fd]
+                try:
+                    view = view[os.write(fd, view[:_PIPE_SIZE]):]
+                except OSError as e:
+                    if e.errno == errno.EAGAIN:
+                        continue
+                    view = None     # reader went away
+                if view:
+                    pending[fd] = view
+                else:
+                    poller.unregister(fd)
+                    os.close(fd)
+                    del pending[fd]
+
+_pump = _Pump()
+
+
+class Iter2Pipe(object):
+    """ Bridge from python iterator to a pipe, run on a pooled thread """
+    __slots__ = ('source', '_data', '_pending_exception', '_readfd',
+                 '_writefd', '_bufsize')
 
     def __init__(self, obj):
-        self.source = make_readable(obj)
+        if isinstance(obj, (list, tuple)):
+            data = _serialize(obj, _PUMP_MAX)
+            if data is not None:
+                obj = data
+        if isinstance(obj, (str, bytes)):
+            # in-memory data is written by the shared pump thread
+            self._data = obj if isinstance(obj, bytes) else obj.encode('utf-8')
+            self.source = None
+        else:
+            self._data = None
+            # iterators are read directly: the feeder already reads in
+            # large blocks, another buffering layer would only copy
+            self.source = obj if hasattr(obj, 'read') else _RawIterIO(obj)
         self._pending_exception = None
-        threading.Thread.__init__(self)
+        self._readfd = None
 
     def fileno(self):
         """ File descriptor through which iterator data may be read. """
-        if not self.is_alive():
+        if self._readfd is None:
             self._initthread()
         return self._readfd
 
     def close(self):
+        self._closefd()
         # Propagate iteration raised in thread:
         if self._pending_exception:
-            etype, evalue, traceback = self._pending_exception
-            self._pending_exception = None
-            try:
-                raise evalue.with_traceback(traceback)
-            except AttributeError:
-                exec('raise etype, evalue, traceback')
+            exc_info, self._pending_exception = self._pending_exception, None
+            _reraise(*exc_info)
 
     __del__ = close
 
     ### internal methods:
 
+    def _closefd(self):
+        """ Close the parent's copy of the read end """
+        if self._readfd is not None and self._readfd >= 0:
+            os.close(self._readfd)
+            self._readfd = -1
+
     def _initthread(self):
-        """ Create thread to read from iterable and write to pipe """
-        self._readfd, self._writefd = os.pipe()
+        """ Create pipe and hand the bridge over to a feeder thread """
+        self._readfd, self._writefd = _cloexec_pipe()
 
-        # ensure write side of pipe is not inherited by child process
-        import fcntl
-        flags = fcntl.fcntl(self._writefd, fcntl.F_GETFD)
-        fcntl.fcntl(self._writefd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self._bufsize = _PIPE_BLKSIZE
 
-        # Get pipe buffer size
-        try:
-            self._bufsize = os.fstat(self._writefd).st_blksize
-        except (os.error, AttributeError):
-            self._bufsize = 2048   # too small better than too big - may cause blocking
-        self.start()
+        if self._data is not None:
+            # size of in-memory data is known: enlarge pipe only if large
+            _growpipe(self._writefd, len(self._data))
+            _pump.add(self._writefd, self._data)
+            self._data = None
+        else:
+            _feeders.submit(self.run)
 
     def run(self):
-        """ Thread main function """
-        import sys
+        """ Feeder thread main function """
         try:
+            source, writefd, minsize = self.source, self._writefd, self._bufsize
+            # iterators hand over their own buffers, never copied; written
+            # with one writev() if possible
+            readv = getattr(source, 'readv', None)
+            # other file-likes read into one reused buffer, not new strings
+            readinto = None if readv else getattr(source, 'readinto', None)
+            buf = memoryview(b'')
+            # Only in-memory sources never block: reading ahead of them
+            # cannot hold back data that a child is waiting for
+            adapt = isinstance(source, io.BytesIO)
+            bufsize, maxsize = minsize, max(minsize, _PIPE_DEFAULT)
+            written, grown = 0, False
             while True:
                 try:
-                    buf = self.source.read(self._bufsize)
+                    if readv is not None:
+                        # an iterator may block between items: pass on
+                        # each chunk (at most a pipe block of small items)
+                        # as soon as it is in hand
+                        parts = readv(maxsize, 1)
+                    elif readinto is not None:
+                        if len(buf) < bufsize:
+                            buf = memoryview(bytearray(bufsize))
+                        parts = [buf[:readinto(buf[:bufsize]) or 0]]
+                    else:
+                        parts = [source.read(bufsize)]
                 except Exception:
                     self._pending_exception = sys.exc_info()
                     break
-                if not buf:
+                size = sum(map(len, parts))
+                if not size:
                     break
                 try:
-                    os.write(self._writefd, buf)
+                    _writeall(writefd, parts)
                 except OSError:
                     return
+                written += size
+                if not grown and written >= _PIPE_SIZE:
+                    # a long stream: worth a bigger pipe
+                    grown = True
+                    maxsize = max(maxsize, _growpipe(writefd, _PIPE_SIZE))
+                if adapt:
+                    # Adapt block size: grow while the source keeps filling
+                    # whole blocks, drop back as soon as it returns short
+                    if size < bufsize:
+                        bufsize = minsize
+                    elif bufsize < maxsize:
+                        bufsize = min(bufsize * 2, maxsize)
         finally:
             os.close(self._writefd)
             self.source.close()